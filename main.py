@@ -3,16 +3,19 @@
 
 import logging
 import re
-import json
 import asyncio
 import os
+from collections import OrderedDict
+from datetime import timedelta
 from io import BytesIO
-from typing import List, Dict, Literal, Union
+from functools import lru_cache
+from typing import List, Dict, Literal, Tuple, TypedDict, Union
 from traceback import print_exc
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
+import orjson
+from bs4 import BeautifulSoup, Tag
 import minify_html
-import feedparser
+from lxml import etree
 
 from telegram import constants, InputMediaPhoto, Bot, error
 
@@ -38,7 +41,14 @@ Post = Union[
         str,
     ],
 ]
-ScraperState = Dict[Literal["visited"], List[str]]
+
+
+class ScraperState(TypedDict):
+    """爬虫状态"""
+
+    visited: OrderedDict[str, None]
+    etag: str | None
+    last_modified: str | None
 
 
 class HTTPFailed(Exception):
@@ -49,6 +59,35 @@ class ParseFeedFailed(Exception):
     """解析信息错误"""
 
 
+USER_AGENT = "RssScraper/0.1 (Maintained by puddin) "
+IMAGE_EXT_RE = re.compile(
+    r"\.(?:jpg|jpeg|png|gif|webp)(?:\?|$)", re.IGNORECASE
+)
+RSS_PARSER = etree.XMLParser(
+    resolve_entities=False, no_network=True, recover=True
+)
+# 被telegram限制频率时最多尝试发送的次数
+SEND_RETRIES = 3
+
+# telegram的HTML模式支持的标签
+TELEGRAM_TAGS = {
+    "a",
+    "b",
+    "strong",
+    "i",
+    "em",
+    "u",
+    "ins",
+    "s",
+    "strike",
+    "del",
+    "code",
+    "pre",
+    "blockquote",
+}
+# 连同内容一起去掉的标签
+DROPPED_TAGS = {"head", "script", "style"}
+
 HTML_MESSAGE = """
 <b>{title}</b>
 ---
@@ -57,46 +96,91 @@ HTML_MESSAGE = """
 """
 
 
-def html_minify(html_doc: str) -> str:
-    """将HTML中多余的标签去除以便telegram渲染
+def html_minify(soup: BeautifulSoup) -> str:
+    """将HTML中多余的标签去除以便telegram渲染，会直接修改传入的soup
 
     Args:
-        html_doc (str): 需要处理的html
+        soup (BeautifulSoup): 需要处理的html
 
     Returns:
         str: 处理结果
     """
-    logging.info("Minify documents with length of %d", len(html_doc))
-    soup = BeautifulSoup(minify_html.minify(html_doc), "html.parser")
-    for _ in range(len(html_doc)):
-        soup_length = len(str(soup))
-        for tag in soup.find_all(True)[::-1]:
-            child = list(tag.children)
-            if tag.name == "br":
-                tag.replace_with("\n")
-            elif tag.name == "p":
-                tag.replace_with("\n" + tag.text.strip())
-            elif tag.name == "li":
-                tag.replace_with(tag.text.strip() + child[0])
-            elif tag.name in ["a", "b", "strong", "i", "em"]:
-                continue
-            elif not child:
-                tag.replace_with(tag.text.strip())
-            elif len(child) == 1:
-                tag.replace_with(child[0])
-        if len(str(soup)) == soup_length:
-            break
+
+    def rewrite(tag: Tag):
+        # 先处理子节点，这样每个标签只需要处理一次
+        for node in list(tag.children):
+            if isinstance(node, Tag):
+                rewrite(node)
+        if tag.name == "br":
+            tag.replace_with("\n")
+        elif tag.name == "p":
+            tag.replace_with("\n" + tag.text.strip())
+        elif tag.name in ["li", "tr"]:
+            tag.replace_with("\n" + tag.text.strip())
+        elif tag.name in DROPPED_TAGS:
+            tag.decompose()
+        elif tag.name not in TELEGRAM_TAGS:
+            # telegram不支持的标签只保留里面的内容
+            tag.unwrap()
+
+    for node in list(soup.children):
+        if isinstance(node, Tag):
+            rewrite(node)
     html_str = str(soup)
     return html_str
 
 
+def find_image(soup: BeautifulSoup) -> str | None:
+    """找到html中的图片
+
+    Args:
+        soup (BeautifulSoup): 需要查找的html
+
+    Returns:
+        str | None: 图片链接
+    """
+    for element in soup.find_all("a"):
+        href = element.attrs.get("href")
+        if not href:
+            continue
+        if IMAGE_EXT_RE.search(href) or "imgur" in href:
+            return href
+    return None
+
+
+@lru_cache(maxsize=256)
+def parse_description(html_doc: str) -> Tuple[str, str | None]:
+    """只解析一次post的描述，找到其中的图片并去除多余的标签
+
+    Args:
+        html_doc (str): post的描述
+
+    Returns:
+        Tuple[str, str | None]: 处理后的描述和图片链接
+    """
+    if "<" not in html_doc:
+        # 纯文本，不需要解析
+        return html_doc.strip(), None
+    logging.info("Minify documents with length of %d", len(html_doc))
+    soup = BeautifulSoup(minify_html.minify(html_doc), "lxml")
+    # 必须在html_minify之前找图片，<p>等标签里的链接会被去掉
+    image = find_image(soup)
+    return html_minify(soup), image
+
+
 class Scraper:
     """RSS爬虫"""
 
     def __init__(self, url: str, state=None):
         self.url = url
         self.state: ScraperState = (
-            state if state is not None else {"visited": []}
+            state
+            if state is not None
+            else {
+                "visited": OrderedDict(),
+                "etag": None,
+                "last_modified": None,
+            }
         )
 
     def filter_posts(self, posts: List[Post]) -> List[Post]:
@@ -120,12 +204,19 @@ class Scraper:
         Args:
             posts (List[Post]): 需要标记的post
         """
-        self.state["visited"] += [post["guid"] for post in posts]
-        self.state["visited"] = self.state["visited"][-500:]
+        for post in posts:
+            self.state["visited"][post["guid"]] = None
+        while len(self.state["visited"]) > 500:
+            self.state["visited"].popitem(last=False)
 
-    def fetch_new_posts(self) -> List[Post]:
+    async def fetch_new_posts(
+        self, session: aiohttp.ClientSession
+    ) -> List[Post]:
         """获取新的posts
 
+        Args:
+            session (aiohttp.ClientSession): HTTP会话
+
         Raises:
             HTTPFailed: HTTP失败
             ParseFeedFailed: 解析失败
@@ -133,72 +224,74 @@ class Scraper:
         Returns:
             List[Post]: 爬取到的post
         """
+        headers: Dict[str, str] = {}
+        etag = self.state["etag"]
+        last_modified = self.state["last_modified"]
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
         try:
-            resp = requests.get(
+            async with session.get(
                 self.url,
-                headers={
-                    "User-Agent": "RssScraper/0.1 (Maintained by puddin) "
-                },
-                timeout=10,
-            )
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=10),
+            ) as resp:
+                status = resp.status
+                etag = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+                content = await resp.read()
         except Exception as exc:
             raise HTTPFailed() from exc
-        if resp.status_code != 200:
-            raise HTTPFailed(f"Wrong Status Code: {resp.status_code}")
+        if status == 304:
+            logging.info("Feed not modified")
+            return []
+        if status != 200:
+            raise HTTPFailed(f"Wrong Status Code: {status}")
         try:
-            rss = feedparser.parse(resp.text)
+            root = etree.fromstring(content, RSS_PARSER)
         except Exception as exc:
             raise ParseFeedFailed() from exc
-        return [
-            {
-                "guid": item["id"],
-                "title": item["title"],
-                "link": item["link"],
-                "description": item["summary"],
-                "comments": item["comments"],
-            }
-            for item in rss.entries
-        ]
+        if root is None or root.tag != "rss":
+            raise ParseFeedFailed("Response is not an RSS feed")
+        self.state["etag"] = etag
+        self.state["last_modified"] = last_modified
+        posts = []
+        for item in root.iter("item"):
+            guid = item.findtext("guid")
+            if not guid:
+                # 没有guid的item无法去重，直接跳过
+                continue
+            posts.append(
+                {
+                    "guid": guid,
+                    "title": item.findtext("title", default=""),
+                    "link": item.findtext("link", default=""),
+                    "description": item.findtext("description", default=""),
+                    "comments": item.findtext("comments", default=""),
+                }
+            )
+        return posts
 
-    def find_image(self, post: Post) -> str | None:
-        """找到一个post中的图片
+    async def new_posts(self, session: aiohttp.ClientSession) -> List[Post]:
+        """获取当前的所有post，寻找其中的图片并更新当前状态
 
         Args:
-            post (Post): Post
-
-        Returns:
-            str | None: 图片链接
-        """
-        desc = post["description"]
-        doc = BeautifulSoup(desc, "html.parser")
-        for element in doc.find_all("a"):
-            if "href" not in element.attrs:
-                continue
-            if (
-                re.search(
-                    r"\.(jpg|jpeg|png|gif|webp)$", element.attrs["href"]
-                )
-                or "imgur" in element.attrs["href"]
-            ):
-                return element.attrs["href"]
-        return None
-
-    def new_posts(self) -> List[Post]:
-        """获取当前的所有post，寻找其中的图片并更新当前状态
+            session (aiohttp.ClientSession): HTTP会话
 
         Returns:
             List[Post]: 所有Post
         """
-        posts = self.fetch_new_posts()
+        posts = await self.fetch_new_posts(session)
         logging.info("There's %d posts", len(posts))
         posts = self.filter_posts(posts)
         logging.info("There's %d new posts", len(posts))
 
         self.record_posts(posts)
-        for data in posts:
-            data["description"] = html_minify(data["description"])
         for post in posts:
-            post["image"] = self.find_image(post)
+            post["description"], post["image"] = parse_description(
+                post["description"]
+            )
         logging.info("Done finding new posts")
         return posts
 
@@ -208,7 +301,12 @@ class Scraper:
         Args:
             file (File): 打开的文件，不会主动关闭
         """
-        json.dump(self.state, file, indent=2)
+        state = {
+            "visited": list(self.state["visited"]),
+            "etag": self.state["etag"],
+            "last_modified": self.state["last_modified"],
+        }
+        file.write(orjson.dumps(state, option=orjson.OPT_INDENT_2).decode())
 
     def load(self, file):
         """从文件中加载状态
@@ -216,7 +314,12 @@ class Scraper:
         Args:
             fp (_type_): 文件
         """
-        self.state = json.load(file)
+        state = orjson.loads(file.read())
+        self.state = {
+            "visited": OrderedDict.fromkeys(state["visited"]),
+            "etag": state.get("etag"),
+            "last_modified": state.get("last_modified"),
+        }
 
     def refuse(self, post: Post):
         """从状态中删除之前爬取过的Post
@@ -224,54 +327,109 @@ class Scraper:
         Args:
             post (Post): 需要删除的Post
         """
-        if post["guid"] in self.state["visited"]:
-            self.state["visited"].remove(post["guid"])
+        self.state["visited"].pop(post["guid"], None)
+        # 清除缓存标记，保证下次能重新拿到这个post
+        self.state["etag"] = None
+        self.state["last_modified"] = None
 
 
-async def send_post(bot: Bot, chat_id: int | str, post: Post) -> bool:
+async def fetch_image(session: aiohttp.ClientSession, url: str) -> bytes:
+    """下载图片
+
+    Args:
+        session (aiohttp.ClientSession): HTTP会话
+        url (str): 图片链接
+
+    Raises:
+        HTTPFailed: HTTP失败
+
+    Returns:
+        bytes: 图片内容
+    """
+    async with session.get(
+        url, timeout=aiohttp.ClientTimeout(total=60)
+    ) as resp:
+        if resp.status != 200:
+            raise HTTPFailed(f"Wrong Status Code: {resp.status}")
+        return await resp.read()
+
+
+async def send_post(
+    bot: Bot,
+    chat_id: int | str,
+    post: Post,
+    session: aiohttp.ClientSession,
+) -> bool:
     """发送post到telegram
 
     Args:
         bot (Bot): telegram bot实例
         chat_id (int | str): 发送目标
         post (Post): 需要发送的post
+        session (aiohttp.ClientSession): telegram无法获取图片时用来下载图片
 
     Returns:
         bool: 是否发送成功
     """
-    try:
-        if "image" in post:
-            resp = requests.get(post["image"], timeout=60)
-            await bot.send_media_group(
-                chat_id=chat_id,
-                media=[
-                    InputMediaPhoto(
-                        BytesIO(resp.content),
-                        caption=HTML_MESSAGE.format(
-                            title=post["title"], desc=post["description"]
-                        ),
-                        parse_mode=constants.ParseMode.HTML,
-                    )
-                ],
-            )  # type: ignore
-        else:
-            await bot.send_message(
-                chat_id=chat_id,
-                text=HTML_MESSAGE.format(
-                    title=post["title"], desc=post["description"]
-                ),
-                parse_mode=constants.ParseMode.HTML,
-                disable_web_page_preview=True,
-            )  # type: ignore
-    except error.TimedOut:
-        return False
-    except TelegramError:
-        print_exc()
-        return False
-    except Exception:
-        print_exc()
-        return False
-    return True
+    text = HTML_MESSAGE.format(title=post["title"], desc=post["description"])
+    # 先直接把链接交给telegram，由telegram服务器下载图片
+    photo: str | bytes | None = post.get("image")
+    for attempt in range(SEND_RETRIES):
+        try:
+            if photo:
+                media = photo if isinstance(photo, str) else BytesIO(photo)
+                await bot.send_media_group(
+                    chat_id=chat_id,
+                    media=[
+                        InputMediaPhoto(
+                            media,
+                            caption=text,
+                            parse_mode=constants.ParseMode.HTML,
+                        )
+                    ],
+                )  # type: ignore
+            else:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=text,
+                    parse_mode=constants.ParseMode.HTML,
+                    disable_web_page_preview=True,
+                )  # type: ignore
+        except error.RetryAfter as exc:
+            if attempt == SEND_RETRIES - 1:
+                return False
+            # 触发了频率限制，等待telegram要求的时间后重试
+            retry_after = exc.retry_after
+            delay = (
+                retry_after.total_seconds()
+                if isinstance(retry_after, timedelta)
+                else retry_after
+            )
+            logging.info("Rate limited, retry after %s seconds", delay)
+            await asyncio.sleep(delay)
+            continue
+        except error.BadRequest:
+            if not isinstance(photo, str):
+                print_exc()
+                return False
+            # 图片超过5MB或者telegram访问不到图片链接，自己下载后上传
+            logging.info("Telegram rejected %s, uploading it instead", photo)
+            try:
+                photo = await fetch_image(session, photo)
+            except Exception:
+                print_exc()
+                return False
+            continue
+        except error.TimedOut:
+            return False
+        except TelegramError:
+            print_exc()
+            return False
+        except Exception:
+            print_exc()
+            return False
+        return True
+    return False
 
 
 async def tick(
@@ -288,18 +446,36 @@ async def tick(
         sleep_time (int, optional): 睡眠时间. Defaults to 300.
     """
     posts = None
-    try:
-        posts = scraper.new_posts()
-    except Exception:
-        print_exc()
+    validators = (
+        scraper.state["etag"],
+        scraper.state["last_modified"],
+    )
+    async with aiohttp.ClientSession(
+        headers={
+            "User-Agent": USER_AGENT,
+            "Accept-Encoding": "gzip, deflate",
+        },
+    ) as session:
+        try:
+            posts = await scraper.new_posts(session)
+        except Exception:
+            print_exc()
+            return
+        # 所有post都发到同一个频道，按顺序依次发送以保持顺序并遵守频率限制
+        for post in posts:
+            logging.info("Sending post %s", post["guid"])
+            result = await send_post(bot, chat_id, post, session)
+            if not result:
+                scraper.refuse(post)
+    if not posts and validators == (
+        scraper.state["etag"],
+        scraper.state["last_modified"],
+    ):
         return
-    for post in posts:
-        logging.info("Sending post %s", post["guid"])
-        result = await send_post(bot, chat_id, post)
-        if not result:
-            scraper.refuse(post)
-    with open("scraper.json", "w", encoding="utf-8") as file:
+    # 先写入临时文件再替换，避免写到一半时崩溃损坏状态文件
+    with open("scraper.json.tmp", "w", encoding="utf-8") as file:
         scraper.save(file)
+    os.replace("scraper.json.tmp", "scraper.json")
 
 
 def main():